@@ -6,7 +6,10 @@ from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.exceptions import InvalidSignature
-from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import constant_time, hmac
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.fernet import Fernet, InvalidToken
 from secfs.types import I, Principal, User, Group
 
 keys = {}
@@ -62,18 +65,80 @@ def verify(public_key, signature, data):
 def generate_sym_key():
     return Fernet.generate_key()
 
+# Fernet objects for symmetric keys we have used, so they are only set up once
+fernets = {}
+
+def _fernet(key):
+    f = fernets.get(key)
+    if f is None:
+        f = Fernet(key)
+        fernets[key] = f
+    return f
+
+# convergent ciphertexts start with this byte. Fernet tokens are base64, so
+# they never do.
+convergent_marker = b"\x00"
+
+# (encryption key, MAC key) derived from symmetric keys for convergent
+# encryption, by symmetric key
+convergent_keys = {}
+
+def _convergent_keys(key):
+    k = convergent_keys.get(key)
+    if k is None:
+        import base64
+        derived = HKDF(
+            algorithm=hashes.SHA256(),
+            length=64,
+            salt=None,
+            info=b"secfs convergent encryption",
+            backend=default_backend()
+        ).derive(base64.urlsafe_b64decode(key))
+        k = (derived[:32], derived[32:])
+        convergent_keys[key] = k
+    return k
+
+def _convergent_iv(mac_key, data):
+    h = hmac.HMAC(mac_key, hashes.SHA256(), backend=default_backend())
+    h.update(data)
+    return h.finalize()[:16]
+
+def _ctr(enc_key, iv):
+    return Cipher(algorithms.AES(enc_key), modes.CTR(iv), backend=default_backend())
+
 def decrypt_sym(key, data):
     """
-    Decrypt the given data with the given key.
+    Decrypt the given data with the given key. Data encrypted with or without
+    convergent set can both be decrypted.
     """
-    f = Fernet(key)
+    if data[:1] == convergent_marker:
+        enc_key, mac_key = _convergent_keys(key)
+        iv = data[1:17]
+        d = _ctr(enc_key, iv).decryptor()
+        plain = d.update(data[17:]) + d.finalize()
+        # the IV doubles as the MAC of the plaintext
+        if not constant_time.bytes_eq(_convergent_iv(mac_key, plain), iv):
+            raise InvalidToken
+        return plain
+    f = _fernet(key)
     return f.decrypt(data)
 
-def encrypt_sym(key, data):
+def encrypt_sym(key, data, convergent=False):
     """
     Encrypt the given data with the given key.
+
+    If convergent is set, the encryption is deterministic: the same data
+    encrypted with the same key always gives the same ciphertext, so that
+    the server stores it only once. The IV is a MAC of the data under a key
+    derived from the given key, so only those who hold the key can tell
+    which blocks hold the same data.
     """
-    f = Fernet(key)
+    if convergent:
+        enc_key, mac_key = _convergent_keys(key)
+        iv = _convergent_iv(mac_key, data)
+        e = _ctr(enc_key, iv).encryptor()
+        return convergent_marker + iv + e.update(data) + e.finalize()
+    f = _fernet(key)
     return f.encrypt(data)
 
 def decrypt(private_key, ciphertext):
@@ -70,10 +70,9 @@ def init(owner, users, groups):
 
         node = Inode()
         node.kind = 1
-        node.size = len(bts)
         node.mtime = node.ctime
         node.ctime = time.time()
-        node.blocks = [secfs.store.block.store(bts, None)] # don't encrypt init
+        node.write(0, bts) # don't encrypt init
 
         ihash = secfs.store.block.store(node.bytes(), None) # inodes not encrypted
         i = secfs.tables.modmap(owner, I(owner), ihash)
@@ -152,7 +151,8 @@ def mkdir(parent_i, name, create_as, create_for, encrypt):
 
 def read(read_as, i, off, size):
     """
-    Read reads [off:off+size] bytes from the file at i.
+    Read reads [off:off+size] bytes from the file at i. Only the blocks
+    overlapping the range are fetched, and a memoryview is returned.
     """
     if not isinstance(i, I):
         raise TypeError("{} is not an I, is a {}".format(i, type(i)))
@@ -167,7 +167,22 @@ def read(read_as, i, off, size):
 
     node = get_inode(i)
     table_key = secfs.tables.get_itable_key(i.p, read_as)
-    return node.read(table_key)[off:off+size]
+    return node.read_range(off, size, table_key)
+
+def read_ahead(read_as, i, off, size):
+    """
+    Returns the hashes of the blocks of the file at i that hold
+    [off:off+size], and the key needed to decrypt them, so that they can be
+    fetched before they are read (see secfs.store.block.load_many).
+    """
+    if not secfs.access.can_read(read_as, i):
+        return [], None
+
+    node = get_inode(i)
+    chashes = node.blocks_in(off, size)
+    if not chashes or not node.encrypted:
+        return chashes, None
+    return chashes, secfs.tables.get_itable_key(i.p, read_as)
 
 def write(write_as, i, off, buf):
     """
@@ -187,19 +202,10 @@ def write(write_as, i, off, buf):
     node = get_inode(i)
     table_key = secfs.tables.get_itable_key(i.p, write_as)
 
-    # TODO: this is obviously stupid -- should not get rid of blocks that haven't changed
-    bts = node.read(table_key)
-
-    # write also allows us to extend a file
-    if off + len(buf) > len(bts):
-        bts = bts[:off] + buf
-    else:
-        bts = bts[:off] + buf + bts[off+len(buf):]
-
-    # update the inode
-    node.blocks = [secfs.store.block.store(bts, table_key if node.encrypted else None)]
+    # update the inode; only the chunks touched by the write are re-stored.
+    # write also allows us to extend a file.
+    node.write(off, buf, table_key)
     node.mtime = time.time()
-    node.size = len(bts)
 
     # put new hash in tree
     new_hash = secfs.store.block.store(node.bytes(), None)  # inodes not encrypted
@@ -310,11 +316,12 @@ def rmdir(parent_i, i, name, remove_as):
         unlink(parent_i, i, name, remove_as)
         return i
 
-def readdir(i, off, read_as):
+def readdir(i, off, read_as, limit=None):
     """
     Return a list of is in the directory at i.
     Each returned list item is a tuple of an i and an index. The index can be
-    used to request a suffix of the list at a later time.
+    used to request a suffix of the list at a later time. If limit is given,
+    at most limit items are returned.
     """
     
     table_key = secfs.tables.get_itable_key(i.p, read_as)
@@ -322,7 +329,8 @@ def readdir(i, off, read_as):
     if dr == None:
         return None
 
-    return [(i, index+1) for index, i in enumerate(dr.children) if index >= off]
+    end = None if limit is None else off + limit
+    return [(i, index+1) for index, i in enumerate(dr.children[off:end], off)]
 
 def link(link_as, i, parent_i, name):
     """
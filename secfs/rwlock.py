@@ -0,0 +1,47 @@
+# This file implements the reader/writer lock used by both the SecFS server and
+# client to let read-only operations run concurrently.
+
+import threading
+
+class RWLock:
+    """
+    A reader/writer lock that lets any number of shared holders in at once,
+    but only one exclusive holder. Waiting exclusive holders take precedence
+    over new shared ones, so writers are not starved by a stream of readers.
+    Like threading.Lock, it may be released by a different thread than the one
+    that acquired it, as consecutive RPCs may be served by different threads.
+    """
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+
+    def acquire_shared(self):
+        with self.cond:
+            while self.writer or self.waiting_writers:
+                self.cond.wait()
+            self.readers += 1
+
+    def release_shared(self):
+        with self.cond:
+            if self.readers == 0:
+                raise RuntimeError("release of unlocked shared lock")
+            self.readers -= 1
+            if self.readers == 0:
+                self.cond.notify_all()
+
+    def acquire(self):
+        with self.cond:
+            self.waiting_writers += 1
+            while self.writer or self.readers:
+                self.cond.wait()
+            self.waiting_writers -= 1
+            self.writer = True
+
+    def release(self):
+        with self.cond:
+            if not self.writer:
+                raise RuntimeError("release of unlocked lock")
+            self.writer = False
+            self.cond.notify_all()
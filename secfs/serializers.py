@@ -1,7 +1,8 @@
 import Pyro4
+import Pyro4.util
 import serpent
 
-from secfs.types import Principal, User, Group, VersionStruct, VersionStructList
+from secfs.types import I, Principal, User, Group, VersionStruct, VersionStructList
 
 def serialize_principal(p):
     assert(p.is_group() ^ p.is_user())
@@ -21,7 +22,7 @@ def deserialize_version_struct(classname, d):
         vs.ihandles[deserialize_principal(p)] = ihandle
     for p, version_no in d["versions"]:
         vs.versions[deserialize_principal(p)] = version_no
-    assert(isinstance(d["signature"], dict))
+    # serpent sends bytes base64-encoded in a dict, marshal sends them as is
     vs.signature = serpent.tobytes(d["signature"])
     return vs
 
@@ -34,5 +35,34 @@ def serialize_version_struct(vs):
         "signature": vs.signature
     }
 
+def serialize_i(i):
+    return (serialize_principal(i.p), i.n)
+
+class BinarySerializer(Pyro4.util.MarshalSerializer):
+    """
+    Pyro4's marshal serializer sends bytes as they are, whereas serpent
+    base64-encodes them, but it only converts custom objects passed directly
+    as arguments or return values. This variant also converts the ones nested
+    in containers, such as the version structs in the VSL, and sends
+    principals and Is the way serpent sends their __getstate__.
+    """
+    def convert_obj_into_marshallable(self, obj):
+        if isinstance(obj, Principal):
+            return serialize_principal(obj)
+        if isinstance(obj, I):
+            return serialize_i(obj)
+        t = type(obj)
+        if t is list or t is tuple or t is set or t is frozenset:
+            return t(self.convert_obj_into_marshallable(x) for x in obj)
+        if t is dict:
+            return {self.convert_obj_into_marshallable(k): self.convert_obj_into_marshallable(v) for k, v in obj.items()}
+        return super().convert_obj_into_marshallable(obj)
+
 Pyro4.util.SerializerBase.register_dict_to_class("VersionStruct", deserialize_version_struct)
 Pyro4.util.SerializerBase.register_class_to_dict(VersionStruct, serialize_version_struct)
+
+# Pyro4 picks serializers by name on the client and by id on the server, so
+# replace the stock marshal serializer in both registries
+binary = BinarySerializer()
+Pyro4.util._serializers["marshal"] = binary
+Pyro4.util._serializers_by_id[binary.serializer_id] = binary
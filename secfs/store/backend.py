@@ -0,0 +1,298 @@
+# This file implements the storage backends of the SecFS server. A backend
+# holds the server's blocks by their content hash, and the server state that
+# has to survive restarts (the roots, the VSL and its epochs).
+
+import os
+import mmap
+import pickle
+import struct
+import hashlib
+import threading
+
+class MemoryBackend:
+    """
+    A MemoryBackend keeps all blocks in a dict, and loses everything when the
+    server exits. It holds nothing but plain data, so it can be deep-copied
+    (see the forking support in secfs-server).
+    """
+    def __init__(self):
+        self.blocks = {
+            # chash => block
+        }
+
+    def __repr__(self):
+        return "<MemoryBackend {} blocks>".format(len(self.blocks))
+
+    def __contains__(self, chash):
+        return chash in self.blocks
+
+    def get(self, chash):
+        return self.blocks.get(chash)
+
+    def put(self, chash, blob):
+        self.blocks[chash] = blob
+
+    def delete(self, chash):
+        self.blocks.pop(chash, None)
+
+    def chashes(self):
+        return list(self.blocks.keys())
+
+    def sync(self):
+        pass
+
+    def compact(self):
+        pass
+
+    def load_state(self):
+        return None
+
+    def save_state(self, state):
+        pass
+
+class PackBackend:
+    """
+    A PackBackend appends blocks to pack files in a directory. Each block is
+    written as a header holding its content hash and length, followed by the
+    block itself. An index file records where each block was written, and is
+    read into memory when the backend is opened. Blocks are read through a
+    memory mapping of their pack.
+
+    Writes are only made durable by sync(), so that the blocks stored for a
+    commit are flushed to disk together. Packs and index are only ever
+    appended to; records written after the last sync() that did not fully
+    make it to disk are recovered or discarded when the backend is opened.
+    """
+    # a pack record header is the binary sha224 of the block and its length
+    header = struct.Struct(">28sI")
+    # an index record is the binary sha224, pack number, offset and length.
+    # a record with pack number deleted marks the block as deleted.
+    record = struct.Struct(">28sIQI")
+    deleted = 0xffffffff
+    # packs are not appended to once they reach pack_size bytes
+    pack_size = 256 * 1024 * 1024
+    # compact rewrites packs in which less than min_live of the bytes are
+    # still in use
+    min_live = 0.5
+
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.index = {
+            # chash => (pack, offset, length)
+        }
+        self.maps = {} # pack => mmap of (a prefix of) the pack
+        self.dirty = set() # fds written since the last sync
+
+        ends = self._load_index()
+        packs = sorted(int(f[5:-5]) for f in os.listdir(path) if f.startswith("pack-") and f.endswith(".pack"))
+        self.pack = packs[-1] if packs else 0
+        self.pack_fd = os.open(self._pack_file(self.pack), os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o600)
+        self._recover(ends.get(self.pack, 0))
+        self.index_fd = os.open(os.path.join(path, "index"), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+
+    def __repr__(self):
+        return "<PackBackend {} {} blocks>".format(self.path, len(self.index))
+
+    def __contains__(self, chash):
+        return chash in self.index
+
+    def _pack_file(self, pack):
+        return os.path.join(self.path, "pack-{:06d}.pack".format(pack))
+
+    def _load_index(self):
+        # returns, for each pack, where the last block ever indexed in it ends
+        ends = {}
+        try:
+            with open(os.path.join(self.path, "index"), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return ends
+        # a torn record at the end is ignored, and recovered from the pack
+        end = len(data) - len(data) % self.record.size
+        for chash, pack, off, length in self.record.iter_unpack(data[:end]):
+            if pack == self.deleted:
+                self.index.pop(chash.hex(), None)
+            else:
+                self.index[chash.hex()] = (pack, off, length)
+                ends[pack] = max(ends.get(pack, 0), off + length)
+        if end != len(data):
+            with open(os.path.join(self.path, "index"), "r+b") as f:
+                f.truncate(end)
+        return ends
+
+    def _recover(self, off):
+        """
+        Indexes the blocks after off in the current pack that were written,
+        but not indexed, before the server stopped. Anything after the last
+        intact block is cut off.
+        """
+        size = os.fstat(self.pack_fd).st_size
+        recovered = []
+        with open(self._pack_file(self.pack), "rb") as f:
+            f.seek(off)
+            while off + self.header.size <= size:
+                chash, length = self.header.unpack(f.read(self.header.size))
+                blob = f.read(length)
+                if len(blob) != length or hashlib.sha224(blob).digest() != chash:
+                    break
+                recovered.append((chash.hex(), (self.pack, off + self.header.size, length)))
+                off += self.header.size + length
+        if off != size:
+            print("Discarding {} bytes of incomplete blocks in pack {}".format(size - off, self.pack))
+            os.ftruncate(self.pack_fd, off)
+        if recovered:
+            print("Recovered {} unindexed blocks in pack {}".format(len(recovered), self.pack))
+            with open(os.path.join(self.path, "index"), "ab") as f:
+                for chash, (pack, o, length) in recovered:
+                    self.index[chash] = (pack, o, length)
+                    f.write(self.record.pack(bytes.fromhex(chash), pack, o, length))
+                f.flush()
+                os.fsync(f.fileno())
+
+    def get(self, chash):
+        with self.lock:
+            loc = self.index.get(chash)
+            if loc is None:
+                return None
+            pack, off, length = loc
+            if length == 0:
+                return b""
+            m = self.maps.get(pack)
+            if m is None or off + length > len(m):
+                # (re-)map the pack to cover what has been appended since.
+                # readers may still use the old mapping, so it is left for the
+                # garbage collector to unmap.
+                with open(self._pack_file(pack), "rb") as f:
+                    m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.maps[pack] = m
+        return m[off:off+length]
+
+    def put(self, chash, blob):
+        with self.lock:
+            if chash in self.index:
+                return
+            self._append(chash, blob)
+
+    def _append(self, chash, blob):
+        # called with lock held
+        if os.fstat(self.pack_fd).st_size >= self.pack_size:
+            self._rotate()
+        off = os.fstat(self.pack_fd).st_size + self.header.size
+        os.write(self.pack_fd, self.header.pack(bytes.fromhex(chash), len(blob)) + blob)
+        os.write(self.index_fd, self.record.pack(bytes.fromhex(chash), self.pack, off, len(blob)))
+        self.index[chash] = (self.pack, off, len(blob))
+        self.dirty.add(self.pack_fd)
+        self.dirty.add(self.index_fd)
+
+    def _rotate(self):
+        # starts appending to a new pack; called with lock held
+        self.dirty.add(self.pack_fd)
+        self._sync()
+        os.close(self.pack_fd)
+        self.pack += 1
+        self.pack_fd = os.open(self._pack_file(self.pack), os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o600)
+
+    def delete(self, chash):
+        """
+        Deletes the given block. Its space is only reclaimed by compact().
+        """
+        with self.lock:
+            if self.index.pop(chash, None) is None:
+                return
+            os.write(self.index_fd, self.record.pack(bytes.fromhex(chash), self.deleted, 0, 0))
+            self.dirty.add(self.index_fd)
+
+    def chashes(self):
+        with self.lock:
+            return list(self.index.keys())
+
+    def compact(self):
+        """
+        Moves the blocks still in use out of mostly unused packs, and removes
+        those packs. The index is rewritten without the records of deleted
+        and moved blocks.
+        """
+        with self.lock:
+            live = {}
+            for pack, off, length in self.index.values():
+                live[pack] = live.get(pack, 0) + self.header.size + length
+            victims = []
+            # the current pack is included, as it holds all blocks of stores
+            # smaller than pack_size. it is not appended to once compacted.
+            for pack in range(self.pack + 1):
+                try:
+                    size = os.path.getsize(self._pack_file(pack))
+                except FileNotFoundError:
+                    continue
+                if live.get(pack, 0) < size * self.min_live:
+                    victims.append(pack)
+            if not victims:
+                return
+
+            print("Compacting packs {} of {}".format(victims, self.path))
+            self._rotate()
+            for chash, (pack, off, length) in list(self.index.items()):
+                if pack in victims:
+                    blob = self._read(pack, off, length)
+                    self._append(chash, blob)
+            self.dirty.add(self.pack_fd)
+            self._sync()
+
+            # replace the index before removing the packs it no longer uses
+            tmp = os.path.join(self.path, ".index")
+            with open(tmp, "wb") as f:
+                for chash, (pack, off, length) in self.index.items():
+                    f.write(self.record.pack(bytes.fromhex(chash), pack, off, length))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, os.path.join(self.path, "index"))
+            os.close(self.index_fd)
+            self.index_fd = os.open(os.path.join(self.path, "index"), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+            for pack in victims:
+                self.maps.pop(pack, None)
+                os.unlink(self._pack_file(pack))
+
+    def _read(self, pack, off, length):
+        with open(self._pack_file(pack), "rb") as f:
+            f.seek(off)
+            return f.read(length)
+
+    def sync(self):
+        """
+        Makes all blocks put so far durable.
+        """
+        with self.lock:
+            self._sync()
+
+    def _sync(self):
+        # packs are synced before the index, so indexed blocks are on disk
+        for fd in sorted(self.dirty, key=lambda fd: fd == self.index_fd):
+            os.fsync(fd)
+        self.dirty = set()
+
+    def load_state(self):
+        try:
+            with open(os.path.join(self.path, "state"), "rb") as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save_state(self, state):
+        """
+        Atomically replaces the saved server state. Blocks put before are made
+        durable first, as the state may refer to them.
+        """
+        self.sync()
+        tmp = os.path.join(self.path, ".state")
+        with open(tmp, "wb") as f:
+            pickle.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.path, "state"))
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
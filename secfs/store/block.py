@@ -1,5 +1,9 @@
 # This file handles all interaction with the SecFS server's blob storage.
+import hashlib
+import pickle
+import zlib
 import secfs.crypto
+from secfs.store.cache import LRUCache, DiskCache
 
 # a server connection handle is passed to us at mount time by secfs-fuse
 server = None
@@ -7,28 +11,212 @@ def register(_server):
     global server
     server = _server
 
+# cache holds blocks as stored at the server (i.e. possibly encrypted) by their
+# content hash. plain_cache optionally holds decrypted blocks keyed by their
+# content hash and the key used to decrypt them. disk_cache, if set, is a
+# persistent cache of (possibly encrypted) blocks below cache.
+cache = LRUCache(32 * 1024 * 1024)
+plain_cache = LRUCache(0)
+disk_cache = None
+def configure_cache(max_bytes, plain_max_bytes=0, disk_path=None, disk_max_bytes=0):
+    """
+    Sets the byte budget of the block cache, and of the cache of decrypted
+    blocks. A budget of 0 disables the respective cache. If disk_path is
+    given, blocks are also cached in that directory, up to disk_max_bytes.
+    """
+    global cache
+    global plain_cache
+    global disk_cache
+    cache = LRUCache(max_bytes)
+    plain_cache = LRUCache(plain_max_bytes)
+    disk_cache = None
+    if disk_path and disk_max_bytes:
+        disk_cache = DiskCache(disk_path, disk_max_bytes)
+
+# if convergent is set, blocks are encrypted deterministically (see
+# secfs.crypto.encrypt_sym), so that the server stores identical blocks
+# encrypted with the same key only once.
+convergent = False
+
+# flush() first asks the server which blocks it already holds if a batch holds
+# at least has_blocks_min bytes, and only sends the others.
+has_blocks_min = 256 * 1024
+
+# while a batch is open, stored blocks are kept in pending (chash => block),
+# and only sent to the server (in a single RPC) by flush()
+pending = None
+
+def begin_batch():
+    """
+    Starts buffering stored blocks until the next call to flush().
+    """
+    global pending
+    if pending is None:
+        pending = {}
+
+def flush():
+    """
+    Sends all blocks stored since begin_batch() to the server, and ends the
+    batch.
+    """
+    global server
+    global pending
+    batch = pending
+    pending = None
+    if not batch:
+        return
+
+    chashes = list(batch.keys())
+    if sum(len(blob) for blob in batch.values()) >= has_blocks_min:
+        held = server.has_blocks(chashes)
+        chashes = [chash for chash, h in zip(chashes, held) if not h]
+        if not chashes:
+            return
+    stored = server.store_many([batch[chash] for chash in chashes])
+    if stored != chashes:
+        raise ValueError("server stored blocks under unexpected hashes {} (expected {})".format(stored, chashes))
+
+# data blocks of compressed inodes (see secfs.store.inode) start with a byte
+# that tells how the rest of the block is encoded
+raw = b"\x00"
+deflated = b"\x01"
+# compress() only compresses blocks of which a sample of compress_sample bytes
+# shrinks to less than compress_ratio of its size
+compress_sample = 4096
+compress_ratio = 0.9
+compress_level = 6
+
+def compress(data):
+    """
+    Returns data prefixed with its encoding, compressing it if it looks like
+    it compresses well.
+    """
+    half = compress_sample // 2
+    mid = len(data) // 2
+    sample = bytes(data[:half]) + bytes(data[mid:mid+half])
+    if sample and len(zlib.compress(sample, 1)) < len(sample) * compress_ratio:
+        packed = zlib.compress(data, compress_level)
+        if len(packed) < len(data):
+            return deflated + packed
+    return raw + bytes(data)
+
+def decompress(blob):
+    """
+    Returns the data in a block produced by compress().
+    """
+    if blob[:1] == deflated:
+        return zlib.decompress(blob[1:])
+    if blob[:1] == raw:
+        return blob[1:]
+    raise ValueError("unknown block encoding {}".format(blob[:1]))
+
+def dumps(obj):
+    """
+    Pickles and compresses the given object. Pickles stored uncompressed
+    start with 0x80, which zlib streams never do, so loads() reads both.
+    """
+    return deflate(pickle.dumps(obj))
+
+def deflate(data):
+    # compresses a pickle; see dumps()
+    return zlib.compress(data, compress_level)
+
+def unpack(blob):
+    """
+    Returns the pickle in a block written by dumps(), or stored uncompressed.
+    """
+    if blob[:1] != b"\x80":
+        blob = zlib.decompress(blob)
+    return blob
+
+def loads(blob):
+    return pickle.loads(unpack(blob))
+
+def _decode(blob):
+    # serpent base64 encodes binary data, marshal passes it through as is
+    if isinstance(blob, dict):
+        import base64
+        blob = base64.b64decode(blob["data"])
+    return blob
+
+def _cached(chash):
+    """
+    Returns the given block if it is pending or in any of the caches.
+    """
+    batch = pending
+    if batch is not None and chash in batch:
+        return batch[chash]
+    blob = cache.get(chash)
+    if blob is None and disk_cache:
+        blob = disk_cache.get(chash)
+        cache.put(chash, blob)
+    return blob
+
+def _remember(chash, blob):
+    cache.put(chash, blob)
+    if disk_cache:
+        disk_cache.put(chash, blob)
+
+def _decrypt(chash, blob, key):
+    if blob is None or not key:
+        return blob
+    plain = secfs.crypto.decrypt_sym(key, blob)
+    plain_cache.put((chash, key), plain)
+    return plain
+
 def store(blob, key):
     """
     Store the given blob at the server, and return the content's hash.
     """
     global server
+    plain = blob
+    if key:
+        blob = secfs.crypto.encrypt_sym(key, blob, convergent)
+
+    batch = pending
+    if batch is not None:
+        # the server names blocks by their sha224, so we can do so too
+        chash = hashlib.sha224(blob).hexdigest()
+        batch[chash] = blob
+    else:
+        chash = server.store(blob)
+
+    _remember(chash, blob)
     if key:
-        blob = secfs.crypto.encrypt_sym(key, blob)
-    return server.store(blob)
+        plain_cache.put((chash, key), plain)
+    return chash
 
 def load(chash, key):
     """
     Load the blob with the given content hash from the server.
     """
-    global server
-    blob = server.read(chash)
+    return load_many([chash], key)[0]
 
-    # the RPC layer will base64 encode binary data
-    if "data" in blob:
-        import base64
-        blob = base64.b64decode(blob["data"])
+def load_many(chashes, key):
+    """
+    Load the blobs with the given content hashes, fetching all those that are
+    not cached from the server in a single RPC.
+    """
+    global server
+    blobs = [None] * len(chashes)
+    missing = []
+    for n, chash in enumerate(chashes):
+        if key:
+            blobs[n] = plain_cache.get((chash, key))
+            if blobs[n] is not None:
+                continue
+        blob = _cached(chash)
+        if blob is None:
+            missing.append(n)
+        else:
+            blobs[n] = _decrypt(chash, blob, key)
 
-    if key:
-        blob = secfs.crypto.decrypt_sym(key, blob)
+    if missing:
+        fetched = server.read_many([chashes[n] for n in missing])
+        for n, blob in zip(missing, fetched):
+            blob = _decode(blob)
+            if blob is not None:
+                _remember(chashes[n], blob)
+            blobs[n] = _decrypt(chashes[n], blob, key)
 
-    return blob
+    return blobs
@@ -0,0 +1,174 @@
+# This file implements the client-side caches used by SecFS. Blocks are content
+# addressed and immutable, so cached entries never need to be invalidated; they
+# are only evicted when the cache grows past its budget.
+
+import os
+import string
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+class LRUCache:
+    """
+    An LRUCache maps keys to bytes-like values, and evicts the least recently
+    used entries once the total size of its values exceeds max_bytes. A
+    max_bytes of 0 disables the cache. It is safe to use from multiple threads.
+    Other values can be cached by giving their (approximate) size to put.
+    """
+    def __init__(self, max_bytes):
+        self.lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+
+    def __repr__(self):
+        return "<LRUCache {}/{} bytes, {} entries>".format(self.size, self.max_bytes, len(self.entries))
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        """
+        Returns the value cached for key, or None if there is none.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size=None):
+        """
+        Caches value under key, evicting old entries as necessary. size
+        defaults to len(value). Values that are larger than the whole cache are
+        not cached.
+        """
+        if value is None:
+            return
+        if size is None:
+            size = len(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+class DiskCache:
+    """
+    A DiskCache keeps blocks in files named by their content hash in a local
+    directory, so that they survive remounts and can be shared between client
+    processes. Files are read whole and checked against their content hash,
+    which makes the cache safe on untrusted storage. Once the directory grows
+    past max_bytes, the least recently used files (by mtime, which is bumped
+    on every hit) are removed. It is safe to use from multiple threads.
+    """
+    def __init__(self, path, max_bytes):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.size = sum(size for _, size, _ in self._entries())
+
+    def __repr__(self):
+        return "<DiskCache {} {}/{} bytes>".format(self.path, self.size, self.max_bytes)
+
+    def _entries(self):
+        """
+        Returns (mtime, size, path) for every cached block, oldest first.
+        """
+        entries = []
+        for e in os.scandir(self.path):
+            if e.name.startswith("."):
+                continue # temporary file
+            try:
+                st = e.stat()
+            except FileNotFoundError:
+                continue # evicted by another process
+            entries.append((st.st_mtime, st.st_size, e.path))
+        entries.sort()
+        return entries
+
+    def _file(self, chash):
+        # chashes come from untrusted data; don't let them escape the cache
+        if not chash or any(c not in string.hexdigits for c in chash):
+            return None
+        return os.path.join(self.path, chash)
+
+    def _remove(self, f):
+        try:
+            os.unlink(f)
+        except FileNotFoundError:
+            pass
+
+    def get(self, chash):
+        """
+        Returns the block with the given content hash, or None if it is not
+        cached (or the cached copy is corrupt).
+        """
+        f = self._file(chash)
+        if f is None:
+            return None
+        try:
+            with open(f, "rb") as fd:
+                blob = fd.read()
+            os.utime(f)
+        except FileNotFoundError:
+            return None
+
+        if hashlib.sha224(blob).hexdigest() != chash:
+            print("Dropping corrupt cached block {}".format(chash))
+            self._remove(f)
+            return None
+        return blob
+
+    def put(self, chash, blob):
+        """
+        Writes the given block to the cache, evicting old blocks as necessary.
+        """
+        f = self._file(chash)
+        if f is None or blob is None or len(blob) > self.max_bytes or os.path.exists(f):
+            return
+
+        # write to a temporary file first so readers never see partial blocks
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix=".")
+        with os.fdopen(fd, "wb") as w:
+            w.write(blob)
+        os.replace(tmp, f)
+
+        with self.lock:
+            self.size += len(blob)
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """
+        Removes the least recently used blocks until the cache is at 90% of
+        its budget. Other processes may share the directory, so the current
+        size is recomputed from the directory itself. Must be called with
+        self.lock held.
+        """
+        entries = self._entries()
+        self.size = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 9 // 10
+        for _, size, path in entries:
+            if self.size <= target:
+                break
+            self._remove(path)
+            self.size -= size
@@ -0,0 +1,104 @@
+# This file finds the blocks that are still in use, so that the SecFS server can
+# delete all others. The server cannot decrypt anything, but it does not need
+# to: itables and inodes are never encrypted, and all references between
+# blocks go through them. Directory contents refer to files by i, which is
+# resolved through the itables, and file contents refer to nothing.
+
+import io
+import pickle
+import zlib
+
+class _Unpickler(pickle.Unpickler):
+    """
+    Blocks come from clients, and so may not be trusted to only contain data.
+    This unpickler refuses to load anything but the types SecFS stores.
+    """
+    allowed = {
+        ("secfs.types", "I"),
+        ("secfs.types", "User"),
+        ("secfs.types", "Group"),
+    }
+
+    def find_class(self, module, name):
+        if (module, name) not in self.allowed:
+            raise pickle.UnpicklingError("refusing to load {}.{} from a block".format(module, name))
+        return super().find_class(module, name)
+
+def _loads(blob):
+    # itables may be compressed (see secfs.store.block.dumps)
+    if blob[:1] != b"\x80":
+        blob = zlib.decompress(blob)
+    return _Unpickler(io.BytesIO(blob)).load()
+
+def reachable(read, ihandles):
+    """
+    Returns the hashes of all blocks that can be reached from the itables with
+    the given ihandles. read(chash) must return the block with the given hash,
+    or None if there is no such block.
+
+    A ValueError is raised if an itable or inode cannot be parsed, since the
+    blocks it refers to would otherwise be considered unused.
+    """
+    marked = set()
+
+    def load(chash):
+        blob = read(chash)
+        if blob is None:
+            # already gone; nothing below it can be reached through it
+            return None
+        try:
+            return _loads(blob)
+        except Exception as e:
+            raise ValueError("cannot parse block {}: {}".format(chash, e))
+
+    def mark_inode(ihash):
+        if ihash in marked:
+            return
+        marked.add(ihash)
+        rep = load(ihash)
+        if rep is None:
+            return
+        if not isinstance(rep, dict):
+            raise ValueError("block {} is not an inode".format(ihash))
+        for chash in rep.get("blocks", []):
+            if chash is not None:
+                marked.add(chash)
+
+    def mark_entries(entries):
+        for inumber, ihash in entries:
+            # group itables map to user is instead of inode hashes
+            if isinstance(ihash, str):
+                mark_inode(ihash)
+
+    def mark_node(chash, level):
+        # see secfs.tables.ItableMapping
+        if chash is None or chash in marked:
+            return
+        marked.add(chash)
+        rep = load(chash)
+        if rep is None:
+            return
+        if level == 0:
+            mark_entries(rep)
+        else:
+            if isinstance(rep, tuple):
+                # children and the number of inumbers below each
+                rep = rep[0]
+            for child in rep:
+                mark_node(child, level - 1)
+
+    for ihandle in ihandles:
+        if ihandle in marked:
+            continue
+        marked.add(ihandle)
+        rep = load(ihandle)
+        if rep is None:
+            continue
+        if isinstance(rep, tuple):
+            # itable stored before itables were split into a hash tree
+            mark_entries(rep[0])
+        elif rep.get("mapping") is not None:
+            depth, root = rep["mapping"]
+            mark_node(root, depth)
+
+    return marked
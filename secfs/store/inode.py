@@ -1,7 +1,68 @@
+import bisect
+import hashlib
 import pickle
 import secfs.store.block
 import secfs.crypto
 
+# block_size is the size of the fixed-size chunks that file contents are split
+# into when written. it is recorded in each inode, so changing it only affects
+# files created afterwards.
+block_size = 64 * 1024
+
+# if content_defined is set, files created afterwards are instead split at
+# boundaries chosen by their content (FastCDC-style, see _cut), so that
+# chunks away from an edit keep their hashes even if data shifts. chunks are
+# between min_chunk and max_chunk bytes, and avg_chunk bytes on average.
+#
+# the rolling hash runs in Python, one byte at a time, at roughly 6MB/s. that
+# is far slower than encrypting the chunks, and makes writing data about 70
+# times slower than with fixed-size chunks. it only pays off where the blocks
+# saved are worth more than the client's CPU time, e.g. for large files that
+# are edited in place, and copies of them (with convergent encryption).
+content_defined = False
+min_chunk = 16 * 1024
+avg_chunk = 64 * 1024
+max_chunk = 256 * 1024
+
+# if compression is set, the blocks of files created afterwards are compressed
+# before they are encrypted, unless they look incompressible (see
+# secfs.store.block.compress)
+compression = False
+
+# the rolling hash adds one of these for each byte. they must be the same for
+# all clients, or they would not cut the same content into the same chunks.
+gear = [int.from_bytes(hashlib.sha256(bytes([b])).digest()[:8], "big") for b in range(256)]
+# a chunk ends where the top bits of the hash selected by the mask are all 0.
+# before avg_chunk the mask is harder to match, and after it easier, which
+# keeps chunk sizes close to the average.
+_bits = avg_chunk.bit_length() - 1
+mask_hard = ((1 << (_bits + 2)) - 1) << (64 - _bits - 2)
+mask_easy = ((1 << (_bits - 2)) - 1) << (64 - _bits + 2)
+
+def _cut(data, pos, final):
+    """
+    Returns the length of the content-defined chunk of data starting at pos,
+    or None if the chunk may extend past the end of data. If final is set,
+    data ends where the content does, so the last chunk may be short.
+    """
+    n = len(data) - pos
+    if n <= min_chunk:
+        return n if final else None
+    limit = min(n, max_chunk)
+    normal = min(limit, avg_chunk)
+    g = gear
+    h = 0
+    i = pos + min_chunk
+    for mask, stop in ((mask_hard, pos + normal), (mask_easy, pos + limit)):
+        while i < stop:
+            h = ((h << 1) + g[data[i]]) & 0xffffffffffffffff
+            i += 1
+            if not h & mask:
+                return i - pos
+    if limit == max_chunk or final:
+        return limit
+    return None
+
 class Inode:
     def __init__(self):
         self.size = 0
@@ -11,6 +72,15 @@ class Inode:
         self.ctime = 0
         self.mtime = 0
         self.blocks = []
+        # 0 means the content is not chunked (i.e. a single block of any size)
+        self.block_size = block_size
+        # number of name-hashed buckets of a directory (see secfs.store.tree);
+        # 0 means the entries are in a single block
+        self.buckets = 0
+        # for content-defined chunks, the offset at which each block ends;
+        # None if the content is split every block_size bytes
+        self.ends = [] if content_defined else None
+        self.compressed = 1 if compression else 0
         # TODO(eforde): perhaps take in key of current user when inodes are initialized
         # then can just try to decrypt encrypted things with that key
 
@@ -23,21 +93,189 @@ class Inode:
             return None
 
         n = Inode()
-        n.__dict__.update(pickle.loads(d))
+        rep = pickle.loads(d)
+        # inodes stored before chunking was introduced hold a single block
+        rep.setdefault("block_size", 0)
+        rep.setdefault("buckets", 0)
+        rep.setdefault("ends", None)
+        rep.setdefault("compressed", 0)
+        n.__dict__.update(rep)
         return n
 
-    def read(self, key=None):
+    def _key(self, key):
         """
-        Reads the block content of this inode.
+        Returns the key that should be used for this inode's blocks, or raises
+        a PermissionError if the inode is encrypted and no key was given.
         """
         if self.encrypted and not key:
             # assert False
             # TODO(eforde) Something is reaching this in the tests, look into what it is
             raise PermissionError("No key supplied to read encrypted node {}".format(self))
         if not self.encrypted:  # just don't pass in the key if this isn't encrypted
-            key = None
-        blocks = [secfs.store.block.load(b, key) for b in self.blocks]
-        return b"".join(blocks)
+            return None
+        return key
+
+    def read(self, key=None):
+        """
+        Reads the block content of this inode.
+        """
+        key = self._key(key)
+        return b"".join(self._load_many(self.blocks, key))
+
+    def _load_many(self, chashes, key):
+        # loads the given blocks of this inode's content
+        blocks = secfs.store.block.load_many(chashes, key)
+        if self.compressed:
+            blocks = [secfs.store.block.decompress(b) if b is not None else None for b in blocks]
+        return blocks
+
+    def _store(self, data, key):
+        # stores a block of this inode's content
+        if self.compressed:
+            data = secfs.store.block.compress(data)
+        return secfs.store.block.store(data, key)
+
+    def read_range(self, off, size, key=None):
+        """
+        Reads [off:off+size] of the block content of this inode, only loading
+        the blocks that overlap that range. A memoryview of the data is
+        returned to avoid copying it again when slicing.
+        """
+        key = self._key(key)
+        end = min(off + size, self.size)
+        if not self.block_size and self.ends is None:
+            return memoryview(self.read(key))[off:end]
+        if off >= end:
+            return memoryview(b"")
+
+        first, last = self._span(off, end)
+        blocks = self._load_many(self.blocks[first:last+1], key)
+        data = blocks[0] if len(blocks) == 1 else b"".join(blocks)
+
+        start = self._start(first)
+        return memoryview(data)[off-start:end-start]
+
+    def _span(self, off, end):
+        """
+        Returns the indices of the first and last block holding any of
+        [off:end] of the content, which must be non-empty.
+        """
+        if self.ends is not None:
+            return bisect.bisect_right(self.ends, off), bisect.bisect_left(self.ends, end)
+        return off // self.block_size, (end - 1) // self.block_size
+
+    def _start(self, n):
+        # the offset at which block n starts
+        if self.ends is not None:
+            return self.ends[n-1] if n else 0
+        return n * self.block_size
+
+    def blocks_in(self, off, size):
+        """
+        Returns the hashes of the blocks that hold [off:off+size] of the
+        content of this inode. Unchunked inodes have no such blocks, as their
+        content can only be read in full.
+        """
+        end = min(off + size, self.size)
+        if (not self.block_size and self.ends is None) or off >= end:
+            return []
+        first, last = self._span(off, end)
+        return self.blocks[first:last+1]
+
+    def write(self, off, buf, key=None):
+        """
+        Writes buf into the content of this inode at the given offset, and
+        stores the modified chunks. Only the chunks overlapping
+        [off, off+len(buf)) are re-encrypted and stored; all other chunks keep
+        their current hashes. Writing past the end of the file extends it, and
+        any gap is filled with zeroes.
+        """
+        key = self._key(key)
+        if self.ends is not None:
+            return self._write_content_defined(off, buf, key)
+        if not self.block_size:
+            # re-chunk unchunked content on first write
+            content = self.read(key)
+            self.block_size = block_size
+            self.blocks = []
+            self.size = 0
+            if len(content) != 0:
+                self.write(0, content, key)
+
+        bs = self.block_size
+        end = off + len(buf)
+        if end <= off:
+            return
+        new_size = max(self.size, end)
+
+        first = min(off, self.size) // bs
+        last = (new_size - 1) // bs
+
+        # the content of all affected chunks before the write
+        start = first * bs
+        old = b""
+        if first < len(self.blocks):
+            old = b"".join(self._load_many(self.blocks[first:last+1], key))
+
+        region = bytearray(old)
+        if len(region) < new_size - start:
+            region.extend(b"\0" * (min(new_size, (last+1) * bs) - start - len(region)))
+        region[off-start:end-start] = buf
+
+        new_blocks = [
+            self._store(bytes(region[o:o+bs]), key)
+            for o in range(0, len(region), bs)
+        ]
+        self.blocks = self.blocks[:first] + new_blocks + self.blocks[last+1:]
+        self.size = new_size
+
+    def _write_content_defined(self, off, buf, key):
+        """
+        Like write, but for content-defined chunks. The content is re-chunked
+        from the start of the first block the write touches, until a chunk
+        past the write ends where an old block did. From there on, the old
+        chunks are kept, as chunking them again would give the same chunks.
+        """
+        if len(buf) == 0:
+            return
+        if off > self.size:
+            buf = b"\0" * (off - self.size) + bytes(buf)
+            off = self.size
+        end = off + len(buf)
+
+        # the last block is cut where the content ended, not by its content,
+        # so appends must re-chunk it too
+        first = min(bisect.bisect_right(self.ends, off), len(self.blocks) - 1)
+        first = max(first, 0)
+        last = min(bisect.bisect_left(self.ends, end), len(self.blocks) - 1)
+        start = self._start(first)
+
+        region = bytearray(b"".join(self._load_many(self.blocks[first:last+1], key)))
+        region[off-start:end-start] = buf
+
+        new_blocks = []
+        new_ends = []
+        pos = 0
+        while pos < len(region):
+            n = _cut(region, pos, last >= len(self.blocks) - 1)
+            if n is None:
+                # no boundary before the end of the loaded blocks; load more
+                last += 1
+                region.extend(self._load_many(self.blocks[last:last+1], key)[0])
+                continue
+            new_blocks.append(self._store(bytes(region[pos:pos+n]), key))
+            pos += n
+            new_ends.append(start + pos)
+            if start + pos >= end:
+                k = bisect.bisect_left(self.ends, start + pos)
+                if k < len(self.ends) and self.ends[k] == start + pos:
+                    # back in step with the old chunks
+                    last = k
+                    break
+
+        self.blocks = self.blocks[:first] + new_blocks + self.blocks[last+1:]
+        self.ends = self.ends[:first] + new_ends + self.ends[last+1:]
+        self.size = max(self.size, end)
 
     def bytes(self):
         """
@@ -1,13 +1,35 @@
 # This file provides functionality for manipulating directories in SecFS.
 
+import bisect
+import hashlib
 import pickle
 import secfs.fs
 import secfs.crypto
 import secfs.tables
 import secfs.store.block
+from secfs.store.cache import LRUCache
 from secfs.store.inode import Inode
 from secfs.types import I, Principal, User, Group
 
+# directory entries are spread over the blocks of the directory's inode by the
+# hash of their name, so that looking up, adding or removing an entry only
+# loads and stores a single block. each such bucket is a list of (name, i)
+# sorted by name. when a bucket grows beyond bucket_entries entries, the
+# number of buckets is doubled.
+bucket_entries = 512
+
+# cache holds parsed buckets as (entries, {name: i}), keyed by the bucket's
+# content hash and the key it was decrypted with. buckets are immutable, so
+# repeated lookups in an unchanged directory need neither the server nor
+# decryption. entries are accounted for by the size of their serialization.
+cache = LRUCache(8 * 1024 * 1024)
+def configure_cache(max_bytes):
+    global cache
+    cache = LRUCache(max_bytes)
+
+def _bucket(name, buckets):
+    return int.from_bytes(hashlib.sha256(name).digest()[:8], "big") % buckets
+
 def find_under(dir_i, name, read_as=None):
     """
     Attempts to find the i of the file or directory with the given name under
@@ -18,34 +40,145 @@ def find_under(dir_i, name, read_as=None):
     
     key = secfs.tables.get_itable_key(dir_i.p, read_as) if read_as else None
     dr = Directory(dir_i, key)
-    for f in dr.children:
-        if f[0] == name:
-            return f[1]
-    return None
+    return dr.find(name)
 
 class Directory:
     """
     A Directory is used to marshal and unmarshal the contents of directory
-    inodes. To load a directory, an i must be given.
+    inodes. To load a directory, an i must be given. Buckets are only loaded
+    when they are needed.
     """
     def __init__(self, i, key):
         if not isinstance(i, I):
             raise TypeError("{} is not an I, is a {}".format(i, type(i)))
 
         self.inode = None
-        self.children = []
+        self.buckets = {} # bucket number => entries
+        self.index = {} # bucket number => {name: i}, for unmodified buckets
+        self.dirty = set() # numbers of modified buckets
 
         self.inode = secfs.fs.get_inode(i)
         if self.inode.kind != 0:
             raise TypeError("inode with ihash {} is not a directory".format(secfs.tables.resolve(i)))
         self.encrypted = self.inode.encrypted
+        self.key = key if self.encrypted else None
+
+        if not self.inode.buckets:
+            # directories stored before bucketing are a single pickled list.
+            # they are stored in buckets once they are modified.
+            cnt = self.inode.read(key)
+            children = pickle.loads(cnt) if len(cnt) != 0 else []
+            self._rehash(children, 1)
+
+    def _rehash(self, children, buckets):
+        while any(len(b) > bucket_entries for b in self._split(children, buckets).values()):
+            buckets *= 2
+        self.buckets = self._split(children, buckets)
+        self.index = {}
+        self.dirty = set(range(buckets))
+        self.inode.buckets = buckets
+        self.inode.blocks = [None] * buckets
+
+    def _split(self, children, buckets):
+        split = {b: [] for b in range(buckets)}
+        for name, i in children:
+            split[_bucket(name, buckets)].append((name, i))
+        for b in split:
+            split[b].sort(key=lambda entry: entry[0])
+        return split
+
+    def _load(self, numbers):
+        missing = []
+        for b in numbers:
+            if b in self.buckets:
+                continue
+            if self.inode.blocks[b] is None:
+                # no entry has been added to this bucket yet
+                self.buckets[b] = ()
+                self.index[b] = {}
+                continue
+            parsed = cache.get((self.inode.blocks[b], self.key))
+            if parsed is None:
+                missing.append(b)
+            else:
+                self.buckets[b], self.index[b] = parsed
 
-        cnt = self.inode.read(key)
-        if len(cnt) != 0:
-            self.children = pickle.loads(cnt)
+        blobs = secfs.store.block.load_many([self.inode.blocks[b] for b in missing], self.key)
+        for b, blob in zip(missing, blobs):
+            if blob is None:
+                # storing the bucket again would lose all entries in it
+                raise KeyError("No block for directory bucket {}".format(self.inode.blocks[b]))
+            data = secfs.store.block.unpack(blob)
+            self.buckets[b] = tuple(pickle.loads(data))
+            self.index[b] = dict(self.buckets[b])
+            # charged by the size of the pickle rather than of the compressed
+            # block, as the parsed entries grow with the former
+            cache.put((self.inode.blocks[b], self.key), (self.buckets[b], self.index[b]), len(data))
 
-    def bytes(self):
-        return pickle.dumps(self.children)
+    def _entries(self, name):
+        # returns the bucket for name, ready to be modified
+        b = _bucket(name, self.inode.buckets)
+        self._load([b])
+        if b not in self.dirty:
+            # cached buckets are shared, so modify a copy
+            self.buckets[b] = list(self.buckets[b])
+            self.index.pop(b, None)
+        entries = self.buckets[b]
+        n = bisect.bisect_left(entries, (name,))
+        return b, entries, n
+
+    @property
+    def children(self):
+        """
+        All (name, i) entries of the directory.
+        """
+        self._load(range(self.inode.buckets))
+        return [entry for b in range(self.inode.buckets) for entry in self.buckets[b]]
+
+    def find(self, name):
+        b = _bucket(name, self.inode.buckets)
+        self._load([b])
+        if b in self.index:
+            return self.index[b].get(name)
+        entries = self.buckets[b]
+        n = bisect.bisect_left(entries, (name,))
+        if n < len(entries) and entries[n][0] == name:
+            return entries[n][1]
+        return None
+
+    def add(self, name, i):
+        b, entries, n = self._entries(name)
+        if n < len(entries) and entries[n][0] == name:
+            return False
+        entries.insert(n, (name, i))
+        self.dirty.add(b)
+        if len(entries) > bucket_entries:
+            self._rehash(self.children, self.inode.buckets * 2)
+        return True
+
+    def remove(self, name):
+        b, entries, n = self._entries(name)
+        if n < len(entries) and entries[n][0] == name:
+            del entries[n]
+            self.dirty.add(b)
+            return True
+        return False
+
+    def store(self):
+        """
+        Stores the modified buckets and the directory inode, and returns the
+        new inode hash.
+        """
+        for b in sorted(self.dirty):
+            entries = tuple(self.buckets[b])
+            data = pickle.dumps(list(entries))
+            blob = secfs.store.block.deflate(data)
+            self.inode.blocks[b] = secfs.store.block.store(blob, self.key)
+            self.buckets[b] = entries
+            self.index[b] = dict(entries)
+            cache.put((self.inode.blocks[b], self.key), (entries, self.index[b]), len(data))
+        self.dirty = set()
+        return secfs.store.block.store(self.inode.bytes(), None) # inodes not encrypted
 
 def add(dir_i, name, i, key=None):
     """
@@ -58,18 +191,9 @@ def add(dir_i, name, i, key=None):
         raise TypeError("{} is not an I, is a {}".format(i, type(i)))
 
     dr = Directory(dir_i, key)
-    if not dr.encrypted:
-        key = None
-    for f in dr.children:
-        if f[0] == name:
-            raise KeyError("asked to add i {} to dir {} under name {}, but name already exists".format(i, dir_i, name))
-
-    dr.children.append((name, i))
-
-    new_dhash = secfs.store.block.store(dr.bytes(), key)
-    dr.inode.blocks = [new_dhash]
-    new_ihash = secfs.store.block.store(dr.inode.bytes(), None) # inodes not encrypted
-    return new_ihash
+    if not dr.add(name, i):
+        raise KeyError("asked to add i {} to dir {} under name {}, but name already exists".format(i, dir_i, name))
+    return dr.store()
 
 def remove(dir_i, name, key=None):
     """
@@ -79,16 +203,6 @@ def remove(dir_i, name, key=None):
         raise TypeError("{} is not an I, is a {}".format(dir_i, type(dir_i)))
 
     dr = Directory(dir_i, key)
-    if not dr.encrypted:
-        key = None
-
-    for f in range(len(dr.children)):
-        if dr.children[f][0] == name:
-             print("Removed child {} from dir{} children".format(name, dir_i))
-             del dr.children[f]
-             break
-    new_dhash = secfs.store.block.store(dr.bytes(), key)
-    dr.inode.blocks = [new_dhash]
-    new_ihash = secfs.store.block.store(dr.inode.bytes(), None) # inodes not encrypted
- 
-    return new_ihash
+    if dr.remove(name):
+        print("Removed child {} from dir{} children".format(name, dir_i))
+    return dr.store()
@@ -6,19 +6,45 @@
 
 
 
-import pickle
+import copy
+import threading
+from collections.abc import MutableMapping
 import secfs.store
+import secfs.store.block
 import secfs.crypto
 import secfs.fs
 from secfs.types import I, Principal, User, Group, VersionStruct, VersionStructList
 
 vsl = VersionStructList()  # User -> VersionStruct
+vsl_epoch = 0  # server epoch that vsl is up to date with
 itables = {}  # Principal -> itable
 last_vs_bytes = None
+# version structs whose signatures are known to be good, as
+# (principal, hash of vs.bytes(), signature)
+verified = {}
+max_verified = 10000
+# symmetric itable keys we have already unwrapped, as
+# (itable owner, encrypted key, user) -> key
+unwrapped_keys = {}
+
+# in optimistic mode, operations run without holding the server lock, and
+# commits fail with CommitConflict if another client committed in the meantime
+optimistic = False
+
+class CommitConflict(RuntimeError):
+    pass
+
+# the user whose modifications have been deferred by post(defer=True), and are
+# yet to be committed (see commit_deferred)
+deferred = None
 
 # a server connection handle is passed to us at mount time by secfs-fuse
 server = None
-active_user = None
+# per-thread state of the operation in progress; context.user is the user
+# performing it
+context = threading.local()
+# serializes updates of vsl and itables between concurrent operations
+update_lock = threading.Lock()
 def register(_server):
     global server
     server = _server
@@ -26,50 +52,102 @@ def register(_server):
 def pre(refresh, user):
     """
     Called before all user file system operations, right after we have obtained
-    an exclusive server lock.
+    an exclusive server lock (unless running in optimistic mode).
     """
     print("---PRE", user)
-    update_vsl()
+    with update_lock:
+        # while a commit is deferred, the server lock is held, and so there is
+        # nothing new on the server. the local itables are also ahead of it.
+        if deferred is None:
+            update_vsl()
     assert(user.is_user())
-    global active_user
-    active_user = user
+    context.user = user
+    # blocks stored by the operation are sent to the server in one go by post
+    secfs.store.block.begin_batch()
 
     # refresh usermap and groupmap
     if refresh != None:
         refresh()
 
-def post(push_vs):
+def post(push_vs, defer=False):
+    """
+    Called after all user file system operations. If push_vs is set, the
+    modifications of the operation are committed. If defer is also set, the
+    commit is deferred until the next commit or call to commit_deferred, so
+    that the modifications of several operations are committed (and signed)
+    together. The caller must keep holding the server lock until then.
+    """
     if not push_vs:
         # when creating a root, we should not push a VS (yet)
         # you will probably want to leave this here and
         # put your post() code instead of "pass" below.
+        secfs.store.block.flush()
         return
-    global server
-    global active_user
-    global vsl
-    global itables
+    global deferred
+    user = getattr(context, "user", None)
+    if user is None:
+        # already posted (e.g. post failed, and is called again on cleanup)
+        return
+    context.user = None
+
+    if defer and any(itables[p].updated for p in itables):
+        assert(deferred is None or deferred == user)
+        secfs.store.block.flush()
+        deferred = user
+        print("---POST (commit deferred)\n")
+        return
+
+    _commit(user)
+    print("---POST\n")
+
+def commit_deferred():
+    """
+    Commits the modifications deferred by post, if any.
+    """
+    if deferred is not None:
+        _commit(deferred)
+
+def _commit(user):
+    global deferred
     global last_vs_bytes
-    updated_vs = update_vs(active_user)
+    assert(deferred is None or deferred == user)
+    # if the commit fails, the modifications are thrown away by update_vsl
+    deferred = None
+    updated_vs = update_vs(user)
+    # the VS may only refer to blocks that the server has
+    secfs.store.block.flush()
     if updated_vs is not None:
-        print("Commiting vs {} for".format(updated_vs), active_user)
-        server.commit(active_user, updated_vs)
+        print("Commiting vs {} for".format(updated_vs), user)
+        if optimistic:
+            if server.commit(user, updated_vs, vsl_epoch) is None:
+                # the modified itables will be thrown away by update_vsl
+                raise CommitConflict("VSL changed since epoch {}".format(vsl_epoch))
+        else:
+            server.commit(user, updated_vs)
         last_vs_bytes = updated_vs.bytes()
+        # we will get our own struct back on the next update
+        _remember_verified(user, updated_vs)
 
-    print("---POST\n")
- 
 def update_vs(user):
     if not user in itables:
         # was a read only operation for a new user, nothing to commit
         print("No itable for {}, not committing vs\n".format(user))
         return None
+    if not any(itables[p].updated for p in itables):
+        # read only operation, nothing to commit
+        return None
 
-    vs = vsl.get(user)
+    # vsl holds verified structs that are kept across operations, so work on
+    # a copy until the new struct has been committed
+    vs = copy.deepcopy(vsl.get(user))
     if vs is None:
         print("ALERT!!! VS is none for user", user)
         vs = create_new_vs(user)
-        vsl[user] = vs
+    structs = dict(vsl.items())
+    structs[user] = vs
 
-    # Update ihandles and version numbers for this vs
+    # Update ihandles and version numbers for this vs. modified itables are
+    # only stored here, once for all the modifications being committed.
     for p in itables:
         itable = itables[p]
         if itable.updated:
@@ -78,20 +156,20 @@ def update_vs(user):
                     user in secfs.fs.groupmap[p])
             if vs.set_ihandle(p, itable.save()):
                 vs.set_version(p, itable.version + 1)
-        elif vs.versions[p] < itable.version:
+        elif vs.versions.get(p, 0) < itable.version:
             # make sure all version numbers are up-to-date
-            vs.versions[p] = itables[p].version
+            vs.sync_version(p, itables[p].version)
             if p in vs.ihandles:
                 vs.set_ihandle(p, itable.ihandle)
 
     # Check if the versions structures have a total ordering
-    for u1 in vsl:
-        for u2 in vsl:
-            vs1 = vsl[u1]
-            vs2 = vsl[u2]
+    for u1 in structs:
+        for u2 in structs:
+            vs1 = structs[u1]
+            vs2 = structs[u2]
             gt = False
             lt = False
-            for u3 in vsl:
+            for u3 in structs:
                 gt = gt or vs1.versions.get(u3, 0) > vs2.versions.get(u3, 0)
                 lt = lt or vs1.versions.get(u3, 0) < vs2.versions.get(u3, 0)
             if gt and lt:
@@ -104,32 +182,95 @@ def update_vs(user):
     vs.signature = secfs.crypto.sign(private_key, data)
     return vs
 
+def _remember_verified(user, vs):
+    if len(verified) >= max_verified:
+        # forget the oldest half
+        for k in list(verified)[:max_verified // 2]:
+            del verified[k]
+    verified[(user, secfs.crypto.sha256_hash(vs.bytes()), vs.signature)] = True
+
+def verify_vs(user, vs):
+    """
+    Checks the signature on the given user's version struct. Structs that
+    have been verified before are not checked again.
+    """
+    entry = (user, secfs.crypto.sha256_hash(vs.bytes()), vs.signature)
+    if entry in verified:
+        return True
+
+    if user in secfs.fs.usermap:
+        public_key = secfs.fs.usermap[user]
+    else:
+        print("User {} not in usermap yet, probably during init... {}".format(user, secfs.fs.usermap))
+        public_key = secfs.crypto.keys[user].public_key()
+
+    if not secfs.crypto.verify(public_key, vs.signature, vs.bytes()):
+        return False
+    _remember_verified(user, vs)
+    return True
+
 def update_vsl():
+    """
+    Brings vsl and itables up to date with the server. Only the version
+    structs committed since the last call are fetched and verified, and
+    itables are only rebuilt if something changed.
+    """
     global server
     global vsl
+    global vsl_epoch
     global itables
     global last_vs_bytes
-    vsl = VersionStructList(server.get_vsl())
-    itables = {}
-    # populate itables
-    for user in vsl:
-        vs = vsl[user]
-        if user in secfs.fs.usermap:
-            public_key = secfs.fs.usermap[user]
-        else:
-            print("User {} not in usermap yet, probably during init... {}".format(user, secfs.fs.usermap))
-            public_key = secfs.crypto.keys[user].public_key()
+    epoch, changed = server.get_vsl_since(vsl_epoch)
+    if epoch < vsl_epoch:
+        raise ValueError("Server VSL went back in time from epoch {} to {}".format(vsl_epoch, epoch))
+    changed = VersionStructList(changed)
+
+    # itables modified by an operation that was never committed must be
+    # thrown away
+    dirty = any(itables[p].updated for p in itables)
+    if not len(changed) and not dirty:
+        return
 
-        assert(secfs.crypto.verify(public_key, vs.signature, vs.bytes()))
+    # concurrent operations may be resolving through vsl and itables while
+    # we work, so the new ones are built on the side, and only published once
+    # every struct has been verified and every itable loaded
+    new_vsl = VersionStructList()
+    for user in vsl:
+        new_vsl[user] = vsl[user]
+    for user in changed:
+        vs = changed[user]
+        assert(verify_vs(user, vs))
+        if user in vsl and vs.version < vsl[user].version:
+            raise ValueError("Server rolled back VS of {} from version {} to {}".format(user, vsl[user].version, vs.version))
+        new_vsl[user] = vs
+
+    # populate itables, reusing the itables of the last operation that were
+    # not modified and whose ihandle did not move
+    previous = {(p, itables[p].ihandle): itables[p] for p in itables if not itables[p].updated}
+    new_itables = {}
+    versions = {}
+    for user in new_vsl:
+        vs = new_vsl[user]
         for principal in vs.ihandles:
             ihandle = vs.ihandles[principal]
-            version = vs.versions[principal]
+            version = vs.versions.get(principal, 0)
             print("Principal {} from {}'s VS has version {} ihandle: {}".format(principal, user, version, ihandle))
-            if ((principal in itables and itables[principal].version < version) or
-                principal not in itables):
-                itables[principal] = Itable.load(ihandle, version, principal)
-            elif itables[principal].version == version:
-                assert(itables[principal].ihandle == ihandle)
+            if ((principal in new_itables and versions[principal] < version) or
+                principal not in new_itables):
+                itable = previous.get((principal, ihandle))
+                if itable is None:
+                    itable = Itable.load(ihandle, version, principal)
+                new_itables[principal] = itable
+                versions[principal] = version
+            elif versions[principal] == version:
+                assert(new_itables[principal].ihandle == ihandle)
+    for principal in new_itables:
+        # same ihandle means same content, so reused itables only move version
+        new_itables[principal].version = versions[principal]
+
+    vsl = new_vsl
+    vsl_epoch = epoch
+    itables = new_itables
     print("DOWNLOADED VSL", vsl, type(vsl))
     print("    with itables", itables)
     # not sure how to assert this since another client can act on behalf of same user
@@ -140,11 +281,216 @@ def create_new_vs(principal):
     global itables
     for p in itables:
         # create the version vector, initialized with each principal's version
-        vs.versions[p] = itables[p].version
-    vs.set_ihandle(principal, itables[principal].ihandle)
-    vs.set_version(principal, 1)
+        vs.sync_version(p, itables[p].version)
+    # the ihandle of the principal's itable, and its version, are set by
+    # update_vs, which is the only caller
     return vs
 
+# itable mappings are stored as a hash tree. the leaves hold the entries for
+# leaf_size consecutive inumbers, and each interior node holds the hashes of
+# fanout children, and how many inumbers are mapped below each of them (so
+# unmapped inumbers can be found without loading every leaf). only the nodes
+# on the path from a modified leaf to the root have to be stored again when
+# the itable is saved.
+leaf_size = 128
+fanout = 64
+
+class ItableMapping(MutableMapping):
+    """
+    ItableMapping maps inumbers to ihashes (or is, for groups) like a dict,
+    but keeps them in a hash tree whose nodes are only loaded from the server
+    as they are needed. Nodes are identified by their level (0 for leaves) and
+    their index within it, and node (level, index) is the (index % fanout)-th
+    child of node (level + 1, index // fanout).
+    """
+    def __init__(self, depth=0, root=None):
+        self.depth = depth  # level of the root node
+        self.root = root    # hash of the root node
+        self.nodes = {}     # (level, index) => leaf dict or list of children
+        self.counts = {}    # (level, index) of interior nodes => per child count
+        self.dirty = set()  # (level, index) of nodes modified since save
+
+    def _node(self, level, index):
+        key = (level, index)
+        if key in self.nodes:
+            return self.nodes[key]
+
+        if level == self.depth:
+            chash = self.root
+        else:
+            parent = self._node(level + 1, index // fanout)
+            chash = parent[index % fanout]
+
+        if chash is None:
+            node = {} if level == 0 else [None] * fanout
+            if level != 0:
+                self.counts[key] = [0] * fanout
+        else:
+            b = secfs.store.block.load(chash, None) # itables are not encrypted
+            if b == None:
+                raise KeyError("No block for itable node {}".format(chash))
+            node = secfs.store.block.loads(b)
+            if level == 0:
+                node = dict(node)
+            elif isinstance(node, tuple):
+                node, counts = node
+                self.counts[key] = list(counts)
+            else:
+                # interior nodes stored before counts were kept; they are
+                # counted when needed (see _count)
+                self.counts[key] = [None] * fanout
+        self.nodes[key] = node
+        return node
+
+    def _count(self, level, index):
+        # returns the number of inumbers mapped below the given node
+        node = self._node(level, index)
+        if level == 0:
+            return len(node)
+        counts = self.counts[(level, index)]
+        for n in range(fanout):
+            if counts[n] is None:
+                child = (level - 1, index * fanout + n)
+                exists = node[n] is not None or child in self.nodes
+                counts[n] = self._count(*child) if exists else 0
+        return sum(counts)
+
+    def _recount(self, inumber, delta):
+        # adjusts the counts on the path to the leaf of the given inumber
+        index = inumber // leaf_size
+        for level in range(1, self.depth + 1):
+            counts = self.counts[(level, index // fanout)]
+            if counts[index % fanout] is not None:
+                counts[index % fanout] += delta
+            index //= fanout
+
+    def _leaf(self, inumber):
+        """
+        Returns the leaf that would hold the given inumber, or None if the
+        tree is too shallow to hold it.
+        """
+        index = inumber // leaf_size
+        if index >= fanout ** self.depth:
+            return None
+        return index, self._node(0, index)
+
+    def _grow(self, inumber):
+        # add levels on top until the tree can hold the given inumber
+        while inumber // leaf_size >= fanout ** self.depth:
+            root = [None] * fanout
+            root[0] = self.root
+            counts = [0] * fanout
+            counts[0] = self._count(self.depth, 0)
+            self.depth += 1
+            self.nodes[(self.depth, 0)] = root
+            self.counts[(self.depth, 0)] = counts
+            self.dirty.add((self.depth, 0))
+
+    def __getitem__(self, inumber):
+        leaf = self._leaf(inumber)
+        if leaf is None:
+            raise KeyError(inumber)
+        return leaf[1][inumber]
+
+    def __contains__(self, inumber):
+        leaf = self._leaf(inumber)
+        return leaf is not None and inumber in leaf[1]
+
+    def __setitem__(self, inumber, ihash):
+        self._grow(inumber)
+        index, leaf = self._leaf(inumber)
+        if inumber not in leaf:
+            self._recount(inumber, 1)
+        leaf[inumber] = ihash
+        self.dirty.add((0, index))
+
+    def __delitem__(self, inumber):
+        leaf = self._leaf(inumber)
+        if leaf is None:
+            raise KeyError(inumber)
+        del leaf[1][inumber]
+        self._recount(inumber, -1)
+        self.dirty.add((0, leaf[0]))
+
+    def _leaves(self, level=None, index=0):
+        # yields all leaves below the given node, in inumber order
+        if level is None:
+            level = self.depth
+        node = self._node(level, index)
+        if level == 0:
+            yield node
+            return
+        for n in range(fanout):
+            if node[n] is not None or (level - 1, index * fanout + n) in self.nodes:
+                yield from self._leaves(level - 1, index * fanout + n)
+
+    def __iter__(self):
+        for leaf in self._leaves():
+            yield from sorted(leaf.keys())
+
+    def __len__(self):
+        return self._count(self.depth, 0)
+
+    def hole(self, limit):
+        """
+        Returns the smallest unmapped inumber below limit, or None if all of
+        them are mapped. Only the nodes on the path to it are loaded.
+        """
+        if self._count(self.depth, 0) >= limit:
+            return None
+        return self._hole(self.depth, 0, limit)
+
+    def _hole(self, level, index, limit):
+        span = leaf_size * fanout ** level
+        start = index * span
+        if level == 0:
+            leaf = self._node(0, index)
+            for inumber in range(start, min(start + span, limit)):
+                if inumber not in leaf:
+                    return inumber
+            return None
+
+        self._count(level, index)
+        counts = self.counts[(level, index)]
+        span //= fanout
+        for n in range(fanout):
+            child = start + n * span
+            if child >= limit:
+                break
+            if counts[n] < min(span, limit - child):
+                found = self._hole(level - 1, index * fanout + n, limit)
+                if found is not None:
+                    return found
+        return None
+
+    def save(self):
+        """
+        Stores all nodes modified since the last save, and returns the depth
+        of the tree and the hash of its root.
+        """
+        for level in range(self.depth + 1):
+            for (l, index) in sorted(k for k in self.dirty if k[0] == level):
+                node = self.nodes[(l, index)]
+                if level == 0:
+                    empty = not len(node)
+                    rep = [(i, node[i]) for i in sorted(node.keys())]
+                else:
+                    empty = all(child is None for child in node)
+                    self._count(level, index)
+                    rep = (node, self.counts[(l, index)])
+                chash = None
+                if not empty:
+                    chash = secfs.store.block.store(secfs.store.block.dumps(rep), None) # itables not encrypted
+
+                if level == self.depth:
+                    self.root = chash
+                else:
+                    parent = self._node(level + 1, index // fanout)
+                    parent[index % fanout] = chash
+                    self.dirty.add((level + 1, index // fanout))
+        self.dirty = set()
+        return self.depth, self.root
+
 class Itable:
     """
     An itable holds a particular principal's mappings from inumber (the second
@@ -155,26 +501,40 @@ class Itable:
         self.version = 0
         self.ihandle = None
         self.updated = False
+        self.owner = None
         self.keys = {}  # principals => encrypted key
-        self.mapping = {}  # inumber => ihash
+        self.mapping = ItableMapping()  # inumber => ihash
+        # inumbers are allocated from the holes in the mapping, or are
+        # otherwise next_inumber. None means it is not yet known.
+        self.next_inumber = 0
 
     def create(owner):
         itable = Itable()
+        itable.owner = owner
         itable._generate_private_keys(owner)
         return itable
 
     def load(ihandle, version, owner):
         itable = Itable()
+        itable.owner = owner
         itable.ihandle = ihandle
         itable.version = version
         b = secfs.store.block.load(ihandle, None) # itable should never be encrypted
         if b == None:
             # TODO(eforde): this may happen if we start deleting unused ihandles on the server?
             raise KeyError("No block for ihandle {}".format(_ihandle))
-        rep = pickle.loads(b)
-        for (inumber, ihash) in rep[0]:
+        rep = secfs.store.block.loads(b)
+        if isinstance(rep, tuple):
+            # itables stored before they were split into a hash tree hold the
+            # full mapping. it is stored as a tree when the itable is saved.
+            rep = {"mapping": None, "entries": rep[0], "keys": rep[1]}
+        if rep["mapping"] is not None:
+            itable.mapping = ItableMapping(*rep["mapping"])
+        # older itables do not record the next inumber
+        itable.next_inumber = rep.get("next_inumber")
+        for (inumber, ihash) in rep.get("entries", []):
             itable.mapping[inumber] = ihash
-        for (principal, encrypted_key) in rep[1]:
+        for (principal, encrypted_key) in rep["keys"]:
             itable.keys[Principal.parse(principal)] = encrypted_key
 
         if not len(itable.keys):
@@ -194,11 +554,13 @@ class Itable:
             print("encrypting key {} for user {}".format(private_key, owner))
             # Encrypt this itable's private key with the owner's public key
             self.keys[owner] = secfs.crypto.encrypt(secfs.fs.usermap[owner], private_key)
+            unwrapped_keys[(owner, self.keys[owner], owner)] = private_key
         elif owner.is_group():
             # Encrypt this itable's private key with each member's public key
             for user in secfs.fs.groupmap[owner]:
                 print("encrypting key {} for user {} in group {}".format(private_key, user, owner))
                 self.keys[user] = secfs.crypto.encrypt(secfs.fs.usermap[user], private_key)
+                unwrapped_keys[(owner, self.keys[user], user)] = private_key
         # Mark the table as updated so we upload the itable owners' keys to the server
         # We throw away the private key here, so only owners can decrypt their encrypted key
         self.updated = True
@@ -208,12 +570,37 @@ class Itable:
         return "<Itable v{} {}>".format(self.version, self.ihandle)
 
     def bytes(self):
-        rep = (
-            [(i, self.mapping[i]) for i in sorted(self.mapping.keys())],
-            [(p.__getstate__(), self.keys[p]) for p in sorted(self.keys.keys(), key=lambda k: str(k))]
+        """
+        Returns the serialization of the root of this itable. The modified
+        nodes of its mapping are stored at the server first.
+        """
+        if self.next_inumber is None:
+            self._find_next()
+        rep = {
+            "mapping": self.mapping.save(),
+            "next_inumber": self.next_inumber,
+            "keys": [(p.__getstate__(), self.keys[p]) for p in sorted(self.keys.keys(), key=lambda k: str(k))]
             # TODO(eforde): why do i have to use getstate here
-        )
-        return pickle.dumps(rep)
+        }
+        return secfs.store.block.dumps(rep)
+
+    def _find_next(self):
+        # recovers the next inumber of an itable that did not record it
+        used = list(self.mapping)
+        self.next_inumber = max(used) + 1 if used else 0
+
+    def allocate(self):
+        """
+        Returns an inumber that is not mapped yet. The caller has to map it.
+        Inumbers that were removed from the mapping are reused first.
+        """
+        if self.next_inumber is None:
+            self._find_next()
+        inumber = self.mapping.hole(self.next_inumber)
+        if inumber is None:
+            inumber = self.next_inumber
+            self.next_inumber += 1
+        return inumber
 
     def save(self):
         new_ihandle = secfs.store.block.store(self.bytes(), None) # itables not encrypted
@@ -227,8 +614,13 @@ class Itable:
         """
         if not user in self.keys:
             return None
-        private_key = secfs.crypto.keys[user]
-        return secfs.crypto.decrypt(private_key, self.keys[user])
+        entry = (self.owner, self.keys[user], user)
+        key = unwrapped_keys.get(entry)
+        if key is None:
+            private_key = secfs.crypto.keys[user]
+            key = secfs.crypto.decrypt(private_key, self.keys[user])
+            unwrapped_keys[entry] = key
+        return key
 
 def get_itable_key(table_principal, user):
     if not isinstance(table_principal, Principal):
@@ -354,10 +746,7 @@ def modmap(mod_as, i, ihash):
 
     # look up (or allocate) the inumber for the i we want to modify
     if not i.allocated():
-        inumber = 0
-        while inumber in t.mapping:
-            inumber += 1
-        i.allocate(inumber)
+        i.allocate(t.allocate())
     else:
         if i.n not in t.mapping:
             raise IndexError("invalid inumber")
@@ -367,7 +756,8 @@ def modmap(mod_as, i, ihash):
         print("mapping", i.n, "for group", i.p, "into", t.mapping)
 
     t.mapping[i.n] = ihash # for groups, ihash is an i
-    t.save()
+    # the itable is stored when the modification is committed (see update_vs)
+    t.updated = True
     return i
 
 def remove(i):
@@ -379,5 +769,5 @@ def remove(i):
     assert(i.n in t.mapping)
     print("Removing child i:{} from table mapping".format(i))
     del t.mapping[i.n]
-    t.save()
+    t.updated = True
     
@@ -115,6 +115,7 @@ class VersionStruct:
         self.versions = defaultdict(int)  # principals -> version number
         #TODO(kmfoley): change defaultdict to something better 
         self.signature = ""               # signature of the version struct
+        self._bytes = None                # cached result of bytes()
 
     def __repr__(self):
         return "<VersionStruct v{}, len{}>".format(self.version, len(self.ihandles))
@@ -127,12 +128,13 @@ class VersionStruct:
 
     @property
     def version(self):
-        return self.versions[self.principal]
+        return self.versions.get(self.principal, 0)
 
     def set_ihandle(self, principal, ihandle):
         assert(principal.is_group() or principal == self.principal)
         if self.ihandles.get(principal) != ihandle:
             self.ihandles[principal] = ihandle
+            self._bytes = None
             return True
         return False
 
@@ -142,8 +144,25 @@ class VersionStruct:
         elif principal.is_group():
             assert(version > self.versions[principal])
         self.versions[principal] = version
+        self._bytes = None
+
+    def sync_version(self, principal, version):
+        """
+        Records that this struct has seen the given version of principal's
+        itable, without the checks done by set_version.
+        """
+        self.versions[principal] = version
+        self._bytes = None
 
     def bytes(self):
+        """
+        Returns the serialization of this struct that is signed. The result is
+        cached, so ihandles and versions should only be changed through the
+        set_ methods after the struct has been constructed.
+        """
+        if self._bytes is not None:
+            return self._bytes
+
         key_func = lambda p: str(p)
         ordered_ihandles = tuple([
             (str(p), self.ihandles[p]) for p in
@@ -154,7 +173,8 @@ class VersionStruct:
             sorted(self.versions.keys(), key=key_func)
         ])
         message = (self.principal, ordered_ihandles, ordered_versions)
-        return pickle.dumps(message)
+        self._bytes = pickle.dumps(message)
+        return self._bytes
 
 
 # Wrap dictionary in VersionStructList so we can parse principals from RPCs
@@ -25,15 +25,16 @@ WARN="[ ${YELLOW}INFO${NORMAL} ]"
 
 fuse=0
 nxt_fname="primary-client"
+client_env="" # extra VAR=value settings for the clients started next
 client() {
 	rm -f "$nxt_fname.log" 2>/dev/null
 	if [ $# -eq 0 ]; then
-		# shellcheck disable=SC2024
-		sudo PYTHONUNBUFFERED=1 venv/bin/secfs-fuse "$uri" "$mntat" "root.pub" "user-0-key.pem" "user-$(id -u)-key.pem" "user-666-key.pem" > "$nxt_fname.log" 2> "$nxt_fname.err" &
+		# shellcheck disable=SC2024,SC2086
+		sudo PYTHONUNBUFFERED=1 $client_env venv/bin/secfs-fuse "$uri" "$mntat" "root.pub" "user-0-key.pem" "user-$(id -u)-key.pem" "user-666-key.pem" > "$nxt_fname.log" 2> "$nxt_fname.err" &
 		fuse=$!
 	else
-		# shellcheck disable=SC2024
-		sudo PYTHONUNBUFFERED=1 venv/bin/secfs-fuse "$uri" "$mntat" "$@" > "$nxt_fname.log" 2> "$nxt_fname.err" &
+		# shellcheck disable=SC2024,SC2086
+		sudo PYTHONUNBUFFERED=1 $client_env venv/bin/secfs-fuse "$uri" "$mntat" "$@" > "$nxt_fname.log" 2> "$nxt_fname.err" &
 		fuse=$!
 	fi
 	info "client started; waiting for init"
@@ -84,11 +85,45 @@ popc() {
 	_fuse=''
 }
 
+# sidec starts another client next to the current one, mounted at the absolute
+# path $sidemnt so that tests can reach it from the current mount point. it
+# takes a name, followed by the same arguments as client.
+sidemnt=""
+sidefuse=0
+sidec() {
+	local mnt="$mntat"
+	local fname="$nxt_fname"
+	local pid=$fuse
+	mntat="$rundir/mnt-$1"
+	nxt_fname="$1"
+	shift
+	if [ ! -d "$mntat" ]; then
+		mkdir "$mntat"
+	fi
+	client "$@"
+	sidemnt="$(pwd)/$mntat"
+	sidefuse=$fuse
+	mntat="$mnt"
+	nxt_fname="$fname"
+	fuse=$pid
+}
+sidec_cleanup() {
+	sudo umount "$sidemnt" 2>/dev/null
+	sleep 1 # give it time to unmount cleanly
+	sudo kill -9 $sidefuse 2>/dev/null
+	wait $sidefuse 2>/dev/null
+	sudo umount "$sidemnt" 2>/dev/null
+	sidemnt=""
+}
+
 cleanup() {
 	if [ -n "$1" ]; then
 		ohno "Server or client died!"
 	fi
 
+	if [ -n "$sidemnt" ]; then
+		sidec_cleanup
+	fi
 	if [ -n "$_fuse" ]; then
 		# clean nested instance
 		popc
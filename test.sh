@@ -21,9 +21,10 @@ pip3 install --upgrade -e . > pip.log
 # shellcheck source=test-lib.sh
 . "$base/test-lib.sh"
 
-# start a clean server for testing
+# start a clean server for testing. blocks are kept in a store directory, and
+# may be garbage collected one second after they were last used.
 info "starting server"
-env PYTHONUNBUFFERED=1 venv/bin/secfs-server "$uxsock" > server.log 2> server.err &
+env PYTHONUNBUFFERED=1 SECFS_GC_GRACE=1 venv/bin/secfs-server "$uxsock" "$rundir/store" > server.log 2> server.err &
 server=$!
 
 # wait for server to start and announce its URI
@@ -203,6 +204,93 @@ cant "create file in group-writeable directory as non-member" "echo b | sudo -u
 cant "read back file created in group-writeable directory as non-member" "sudo -u '#666' stat shared/muhaha"
 
 
+section "Concurrent workers"
+# a client with several workers serves reads concurrently, while the primary
+# client keeps committing changes that the reads have to catch up with
+primary="$(pwd)/$mntat"
+pushc "multi-worker-client"
+client_env="SECFS_WORKERS=8"
+client
+client_env=""
+expect "(for n in 1 2 3 4 5 6 7 8; do echo \$n > '$primary'/shared/worker-\$n; done) & for n in 1 2 3 4 5 6 7 8; do (sudo cat root-secret; cat group-secret shared/user-file shared/third-client-file; sudo cat root-only/file; ls . shared/user-only root-only) | md5sum & done | uniq -c; wait" '^ *8 [0-9a-f]{32}  -$' || fail "concurrent reads returned different results"
+expect "sudo cat root-secret" '^supercalifragilisticexpialidocious\ny$' || fail "couldn't read user-readable file with several workers"
+expect "cat group-secret" '^dociousaliexpilisticfragicalirupes\nz$' || fail "couldn't read group-readable file with several workers"
+expect "ls shared | grep -c '^worker-'" '^8$' || fail "files created by another client went missing with several workers"
+expect "cat shared/worker-5" '^5$' || fail "couldn't read file created by another client with several workers"
+popc
+
+
+section "Optimistic concurrency"
+# two optimistic clients create files in the same directory at the same time,
+# so some of their commits conflict and have to be retried
+pushc "optimistic-client"
+client_env="SECFS_OPTIMISTIC=1"
+client
+sidec "optimistic-side-client"
+client_env=""
+expect "for n in 1 2 3 4 5 6 7 8; do echo a\$n | sudo tee opt-a-\$n > /dev/null & echo b\$n | sudo tee '$sidemnt'/opt-b-\$n > /dev/null & done; wait" '^$' || fail "couldn't create files concurrently from optimistic clients"
+expect "ls | grep -c '^opt-'" '^16$' || fail "files created concurrently went missing on first optimistic client"
+expect "ls '$sidemnt' | grep -c '^opt-'" '^16$' || fail "files created concurrently went missing on second optimistic client"
+expect "cat opt-b-3 '$sidemnt'/opt-a-5" '^b3\na5$' || fail "couldn't read back files created by other optimistic client"
+info "%d operations retried after conflicting commits" "$(cat optimistic-client.log optimistic-side-client.log | grep -c '^Retrying')"
+sidec_cleanup
+popc
+expect "ls | grep -c '^opt-'" '^16$' || fail "files created by optimistic clients went missing on locking client"
+
+
+section "Commit window"
+# a client with a commit window commits the changes of all operations in the
+# window together once it closes, and those of each user separately
+pushc "commit-window-client"
+client_env="SECFS_COMMIT_WINDOW=2"
+client
+client_env=""
+expect "for n in 1 2 3 4 5; do echo w\$n | sudo tee window-\$n > /dev/null; done; echo u | tee shared/window-user > /dev/null; echo l | sudo tee window-last > /dev/null" '^$' || fail "couldn't create files in commit window"
+expect "ls | grep -c '^window-'" '^6$' || fail "files created in commit window went missing on same client"
+expect "cat window-3 shared/window-user window-last" '^w3\nu\nl$' || fail "couldn't read back files created in commit window on same client"
+sleep 3 # let the window close
+expect "ls '$primary' | grep -c '^window-'" '^6$' || fail "files created in commit window went missing on other client"
+expect "cat '$primary'/window-3 '$primary'/shared/window-user '$primary'/window-last" '^w3\nu\nl$' || fail "couldn't read back files created in commit window on other client"
+popc
+
+
+section "Compressed, convergent and content-defined blocks"
+# files written with all optional block formats enabled are overwritten in the
+# middle and appended to, and must read back the same on a client that doesn't
+# enable them
+seq 1 200000 > "$rundir/formats"
+printf replaced | dd of="$rundir/formats" bs=1 seek=100000 conv=notrunc 2> /dev/null
+seq 1 10 >> "$rundir/formats"
+formats_sum=$(md5sum < "$rundir/formats")
+pushc "block-formats-client"
+client_env="SECFS_COMPRESS=1 SECFS_CONVERGENT=1 SECFS_CDC=1"
+client
+client_env=""
+expect "seq 1 200000 | sudo tee formats-file > /dev/null" "printf replaced | sudo dd of=formats-file bs=1 seek=100000 conv=notrunc 2> /dev/null" "seq 1 10 | sudo tee -a formats-file > /dev/null" "md5sum < formats-file" "^$formats_sum\$" || fail "couldn't read back file written with all block formats"
+expect "sudo sh -c 'umask 0004; seq 1 200000 > formats-secret'" "printf replaced | sudo dd of=formats-secret bs=1 seek=100000 conv=notrunc 2> /dev/null" "seq 1 10 | sudo tee -a formats-secret > /dev/null" "sudo cat formats-secret | md5sum" "^$formats_sum\$" || fail "couldn't read back encrypted file written with all block formats"
+expect "sudo sh -c 'umask 0004; cp formats-secret formats-copy'" "sudo cat formats-copy | md5sum" "^$formats_sum\$" || fail "couldn't read back copy of encrypted file written with all block formats"
+popc
+expect "md5sum < formats-file" "^$formats_sum\$" || fail "couldn't read file written with all block formats on other client"
+expect "sudo cat formats-secret | md5sum" "^$formats_sum\$" || fail "couldn't read encrypted file written with all block formats on other client"
+expect "sudo cat formats-copy | md5sum" "^$formats_sum\$" || fail "couldn't read copy of encrypted file written with all block formats on other client"
+
+
+section "Garbage collection"
+expect "echo gc-old | sudo tee gc-file" "echo gc-new | sudo tee gc-file" "sudo cat gc-file" '^gc-new$' || fail "couldn't overwrite file before garbage collection"
+expect "echo gc-gone | sudo tee gc-gone" "sudo rm gc-gone" '^$' || fail "couldn't remove file before garbage collection"
+sleep 2 # let the blocks of the changes above outlive the grace period
+packs_before=$(cat "$rundir"/store/pack-*.pack | wc -c)
+swept=$(venv/bin/python -c 'import sys, Pyro4, secfs.serializers; print(Pyro4.Proxy(sys.argv[1]).gc()[1])' "$uri")
+packs_after=$(cat "$rundir"/store/pack-*.pack | wc -c)
+expect "echo '$swept'" '^[1-9][0-9]*$' || fail "garbage collection deleted no blocks"
+expect "test $packs_after -lt $packs_before && echo smaller" '^smaller$' || fail "garbage collection did not shrink the block store ($packs_before to $packs_after bytes)"
+expect "sudo cat gc-file" '^gc-new$' || fail "couldn't read overwritten file after garbage collection"
+expect "cat shared/user-file" '^b\nb$' || fail "couldn't read user file after garbage collection"
+expect "cat shared/third-client-file" '^b\nb$' || fail "couldn't read other client's file after garbage collection"
+expect "sudo cat root-only/file" '^a\na$' || fail "couldn't read nested file after garbage collection"
+expect "ls -la shared" ' *user-only/?$' || fail "couldn't list directory after garbage collection"
+
+
 section "Malicious server"
 pushc "malicious-server-client"
 echo "-----BEGIN PUBLIC KEY-----